@@ -3,31 +3,38 @@
 # Copyright 2024, Bernhard Kaindl
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 import argparse
+import io
+import json
+import multiprocessing
+import os
 import re
+import shlex
 import subprocess
 import sys
-from logging import INFO, basicConfig, info
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from logging import INFO, basicConfig, getLogger, info
 from time import sleep
-from typing import List, Tuple
+from typing import Dict, Generator, Iterable, List, Tuple
 
 import pexpect
 
+# The number of lines at the end of the output of `spack install` to keep for the report:
+INSTALL_TAIL_LINES = 20
 
+
+@lru_cache(maxsize=1)
 def get_os_info() -> Tuple[str, str, str]:
     """Get the OS information."""
-    about_build_host = ""
-    os_name = ""
-    os_version_id = ""
+    # /etc/os-release uses shell syntax, use shlex to parse the quoted values:
     with open("/etc/os-release", encoding="utf-8") as f:
-        os_release = f.read()
-        for line in os_release.split("\n"):
-            if line.startswith("PRETTY_NAME="):
-                about_build_host += " on " + line.split("=")[1].strip().strip('"')
-            if line.startswith("VERSION_ID="):
-                os_version_id = line.split("=")[1].strip().strip('"')
-            if line.startswith("NAME="):
-                os_name = line.split("=")[1].strip().strip('"')
-    return about_build_host, os_name, os_version_id
+        tokens = shlex.split(f.read(), comments=True)
+    os_release = {key: value for key, _, value in (token.partition("=") for token in tokens)}
+    pretty_name = os_release.get("PRETTY_NAME")
+    about_build_host = " on " + pretty_name if pretty_name else ""
+    return about_build_host, os_release.get("NAME", ""), os_release.get("VERSION_ID", "")
 
 
 def get_safe_versions(spec):
@@ -38,7 +45,7 @@ def get_safe_versions(spec):
     """
     safe_versions = []
     # FIXME: The spec may contain variants, etc, use a regex to remove them.
-    recipe = spec.split("+")[0]  # Remove variants, and more as they are added to the spec.
+    recipe = spec.partition("+")[0]  # Remove variants, and more as they are added to the spec.
     err, stdout, _ = run(["bin/spack", "versions", "--safe", recipe])
     if err == 0:
         for line in stdout.split("\n"):
@@ -54,16 +61,55 @@ def get_safe_versions(spec):
     return safe_versions
 
 
+# Parses a spec printed by `bin/spack find --no-groups -v -I`, e.g.:
+# [+] wget@1.21.4~gnutls~libpsl~pcre+ssl build_system=autotools libs=shared
+_RE_FOUND_SPEC = re.compile(r"^(?:\[.\]|-)?\s*([\w-]+)@([^\s+~%^]+)(\S*)")
+
+
+def installed_spec_matches(spec: str, found: "re.Match[str]") -> bool:
+    """Check if the spec from the PR diff is satisfied by the installed spec found."""
+    name, _, version = spec.partition("@")
+    name, *variants = name.split("+")
+    found_name, found_version, found_variants = found.groups()
+    if name != found_name:
+        return False
+    if version and found_version != version and not found_version.startswith(version + "."):
+        return False
+    return all(variant in re.findall(r"\+([\w-]+)", found_variants) for variant in variants)
+
+
 def find_already_installed(recipes):
-    """List the installed packages."""
+    """List the installed packages.
+
+    Each `bin/spack` invocation has a large startup cost, so query all specs
+    at once and match the installed specs to the specs to check afterwards.
+    """
     installed = []
     findings = []
+    # Without specs, `spack find` would list all installed packages:
+    if not recipes:
+        return installed, findings
+    err, stdout, _ = run(["bin/spack", "find", "--no-groups", "-v", "-I", *recipes])
+    if err or not stdout:
+        return installed, findings
+
+    sys.stdout.write(stdout)
+    sys.stdout.write("\n")
+    found_specs = []
+    for line in stdout.split("\n"):
+        # Skip the "==> <n> installed packages" and "-- <arch> / <compiler> --" headers:
+        if line.startswith("==>") or line.startswith("--"):
+            continue
+        found = _RE_FOUND_SPEC.match(line)
+        if found:
+            found_specs.append((found, line.replace(" build_system=python_pip", "")))
+
+    # Several specs to check can match the same installed spec, list each of them once:
     for recipe in recipes:
-        err, stdout, _ = run(["bin/spack", "find", "--no-groups", "-v", "-I", recipe])
-        if err == 0:
-            print(stdout)
+        matches = [line for found, line in found_specs if installed_spec_matches(recipe, found)]
+        if matches:
             installed.append(recipe)
-            findings.append(stdout.replace(" build_system=python_pip", ""))
+            findings.extend(line for line in matches if line not in findings)
     return installed, findings
 
 
@@ -77,9 +123,26 @@ def spack_uninstall_packages(installed):
             sys.exit(ret)
 
 
-def spawn(command, args):
-    """Spawn a command."""
+def spawn(command, args, interactive=False, log_path=""):
+    """Spawn a command, passing its output through, and return its exit status.
+
+    Only use pexpect to run the command in a pty when requested for answering prompts,
+    as it copies the output through Python, which is overhead for long build logs.
+    If a log_path is passed, the output is also written to it using tee.
+    """
     print(" ".join([command, *args]))
+    if not interactive:
+        if not log_path:
+            return subprocess.run([command, *args], check=False).returncode
+        # tee copies the output to stdout and to the log without passing it through Python:
+        with subprocess.Popen(
+            [command, *args], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        ) as proc, subprocess.Popen(["tee", log_path], stdin=proc.stdout) as tee:
+            assert proc.stdout
+            proc.stdout.close()  # tee has the pipe, close ours to not keep it open.
+            tee.wait()
+        return proc.returncode
+
     child = pexpect.spawnu(command, args)
     child.interact()
     child.expect(pexpect.EOF)
@@ -87,145 +150,413 @@ def spawn(command, args):
     return child.exitstatus
 
 
+def log_command(command: List[str]):
+    """Log the command as a copy-pasteable shell command, if INFO messages are logged."""
+    if getLogger().isEnabledFor(INFO):
+        info("%s", shlex.join(command))
+
+
 def run(command: List[str], check=False) -> Tuple[int, str, str]:
-    """Run a command and return the output."""
-    info(" ".join(command))
+    """Run a command and return the output.
+
+    Bytes in the output which are not valid in the locale's encoding are replaced,
+    as the output of builds and downloads is not guaranteed to be in it.
+    """
+    log_command(command)
     cmd: subprocess.CompletedProcess[str] = subprocess.run(
-        command, check=check, text=True, capture_output=True
+        command, check=check, text=True, errors="replace", capture_output=True
     )
     return cmd.returncode, cmd.stdout.strip(), cmd.stderr.strip()
 
 
+def stream_lines(command: List[str]) -> Generator[bytes, None, Tuple[int, str]]:
+    """Yield the lines of the output of a command as bytes, return its exit code and stderr.
+
+    The lines are not decoded, so callers can skip lines without the cost of decoding them.
+    """
+    log_command(command)
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
+        assert proc.stdout and proc.stderr
+        for line in proc.stdout:
+            yield line.rstrip(b"\n")
+        stderr = proc.stderr.read().decode(errors="replace").strip()
+    return proc.returncode, stderr
+
+
+def stream_pr_diff() -> Generator[bytes, None, None]:
+    """Yield the lines of the PR diff of the changed recipes without buffering the diff.
+
+    The most reliable way to get the PR diff is to use the GitHub CLI, but GitHub refuses
+    to return diffs of more than 20000 lines (HTTP 406), and `gh pr diff` can't limit
+    the diff to the changed recipes. When other files are changed as well, or when the
+    diff is too large, use `git diff` of the changed recipes if the PR is checked out.
+    """
+    pr_fields = "baseRefOid,changedFiles,files,headRefOid"
+    ret, stdout, stderr = run(["gh", "pr", "view", "--json", pr_fields])
+    if ret or stderr:
+        print(stderr or stdout)
+        sys.exit(ret or 1)
+    pr = json.loads(stdout)
+    changed_files = [changed_file["path"] for changed_file in pr["files"]]
+    recipe_paths = [path for path in changed_files if _RE_RECIPE.match(path)]
+
+    # Only use git when HEAD is the head of the PR, and diff it against the commit of the
+    # base branch from GitHub, like GitHub does, as the origin remote may be a fork or stale:
+    git_diff = []
+    _, head, _ = run(["git", "rev-parse", "HEAD"])
+    if head == pr["headRefOid"]:
+        git_diff = ["git", "diff", f"{pr['baseRefOid']}...{pr['headRefOid']}"]
+
+    # The list of files is truncated for PRs with many files, get the full diff for them:
+    all_files_listed = len(changed_files) == pr["changedFiles"]
+    if all_files_listed:
+        if not recipe_paths:
+            return
+        if git_diff:
+            git_diff += ["--", *recipe_paths]
+
+    if git_diff and all_files_listed and len(recipe_paths) < len(changed_files):
+        err, stderr = yield from stream_lines(git_diff)
+        if not err:
+            return
+        info("git diff failed, using gh pr diff: %s", stderr)
+
+    err, stderr = yield from stream_lines(["gh", "pr", "diff"])
+    if "HTTP 406" in stderr and git_diff:
+        err, stderr = yield from stream_lines(git_diff)
+    if err or stderr:
+        print(stderr)
+        sys.exit(err or 1)
+
+
+# Regular expressions for parsing the PR diff:
+_RE_RECIPE = re.compile(r"^var/spack/repos/builtin/packages/([^/]+)/package\.py$")
+_RE_VERSION_START = re.compile(r"version\($")
+_RE_VERSION = re.compile(r'version\("([^"]+)", ')
+_RE_QUOTED = re.compile(r'"([^"]+)"')
+_RE_VARIANT = re.compile(r'variant\("([^"]+)", ')
+
+
+def iter_changed_recipes(diff: Iterable[bytes]) -> Generator[Tuple[str, List[str]], None, None]:
+    """Split the diff at the diffs of each file and yield the added lines of each recipe.
+
+    The lines of the diffs of other files are skipped with a single check of each line.
+    Only the paths of changed files and the added lines of recipes are decoded to str.
+    """
+    changed_recipe = ""
+    added_lines: List[str] = []
+    for line in diff:
+        first = line[:1]
+        if first == b"d" and line.startswith(b"diff --git"):
+            if changed_recipe:
+                yield changed_recipe, added_lines
+            changed_recipe = ""
+            added_lines = []
+        elif first != b"+":
+            continue
+        elif line.startswith(b"+++ b/"):
+            # Check if the path of the changed file is a recipe:
+            recipe = _RE_RECIPE.match(line[6:].decode(errors="replace"))
+            changed_recipe = recipe.group(1) if recipe else ""
+        elif changed_recipe and line.startswith(b"+ "):
+            added_lines.append(line.decode(errors="replace"))
+    if changed_recipe:
+        yield changed_recipe, added_lines
+
+
 def get_specs_to_check():
     """Check if the current branch is up-to-date with the remote branch.
 
     Check if the current branch is up-to-date with the remote branch.
     On errors and if not up-to-date, return an error exit code.
     """
-    changed_files = []
-    changed_recipe = ""
-    recipe_paths = []
-    recipes = []
     specs = []
-    variants = []
-    versions = []
-    next_line_is_version = False
-
-    # The most reliable way to get the PR diff is to use the GitHub CLI:
-    err, stdout, stderr = run(["gh", "pr", "diff"])
-    if err or stderr:
-        print(stderr or stdout)
-        sys.exit(err)
 
-    for line in stdout.split("\n"):
-        if line.startswith("diff --git"):
-            changed_recipe = ""
-            versions = []
-            variants = []
-            next_line_is_version = False
-            continue
-        if line[0] != "+":
-            continue
-        # Check if the line is a path to a changed file:
-        changed_path = re.search(r"\+\+\+ b/(.*)", line)
-        if changed_path:
-            changed_file = changed_path.group(1)
-            changed_files.append(changed_file)
-            recipe = re.search(r"var/spack/repos/builtin/packages/(.*)/package.py", changed_file)
-            if recipe:
-                recipe_paths.append(changed_file)
-                changed_recipe = recipe.group(1)
-                recipes.append(changed_recipe)
-                specs.append(changed_recipe)
-            continue
-        if not changed_recipe:
-            continue
+    for changed_recipe, added_lines in iter_changed_recipes(stream_pr_diff()):
+        specs.append(changed_recipe)
+        variants = []
+        versions: List[str] = []
+        next_line_is_version = False
+
+        for line in added_lines:
+            # Get the list of new and changed versions from the PR diff:
+            version_start = _RE_VERSION_START.search(line)
+            if version_start:
+                next_line_is_version = True
+                continue
+            version = _RE_VERSION.search(line)
+            if next_line_is_version or version:
+                next_line_is_version = False
+                version = version or _RE_QUOTED.search(line)
+                if version:
+                    spec = changed_recipe + "@" + version.group(1)
+                    # Add the version to the specs to build:
+                    if changed_recipe in specs:
+                        specs.remove(changed_recipe)
+                    specs.append(spec)
+                continue
 
-        # Get the list of new and changed versions from the PR diff:
-        version_start = re.search(r"version\($", line)
-        if version_start:
-            next_line_is_version = True
-            continue
-        version = re.search(r'version\("(.+)", ', line)
-        if next_line_is_version or version:
-            next_line_is_version = False
-            version = version or re.search(r'"(.+)"', line)
-            if version:
-                spec = changed_recipe + "@" + version.group(1)
+            # TODO: Add support for wrapping the variant in single quotes and on the next line.
+            # TODO: Add support for multi variants.
+            # or, better:
+            # TODO: Add support for getting the list of new and changed variants from spack:
+            variant = _RE_VARIANT.search(line)
+            if variant:
+                variant_str = "+" + variant.group(1)
+                variants.append(variant_str)
                 # Add the version to the specs to build:
                 if changed_recipe in specs:
                     specs.remove(changed_recipe)
-                specs.append(spec)
-            continue
+                specs.append(changed_recipe + variant_str)
 
-        # TODO: Add support for wrapping the variant in single quotes and on the next line.
-        # TODO: Add support for multi variants.
-        # or, better:
-        # TODO: Add support for getting the list of new and changed variants from spack:
-        variant = re.search(r'variant\("(.+)", ', line)
-        if variant:
-            variant_str = "+" + variant.group(1)
-            variants.append(variant_str)
-            # Add the version to the specs to build:
-            if changed_recipe in specs:
-                specs.remove(changed_recipe)
-            specs.append(changed_recipe + variant_str)
+                for version in versions:
+                    spec = changed_recipe + variant_str + "@" + version
+                    specs.append(spec)
 
-            for version in versions:
-                spec = changed_recipe + variant_str + "@" + version
-                specs.append(spec)
+    # Remove duplicate specs from diff hunks changing the same recipe, keeping the order:
+    return list(dict.fromkeys(specs))
 
-    return specs
 
+def get_safe_versions_cache_path() -> str:
+    """Get the path of the cache of safe versions for the checked-out spack commit.
 
-def expand_specs_to_check_package_versions(specs_to_check, max_versions) -> List[str]:
-    """Expand the specs to check by adding the safe versions of the packages."""
-    for spec in specs_to_check.copy():
-        recipe = spec.split("@")[0]
-        versions = get_safe_versions(recipe)
-        if versions:
-            specs_to_check.remove(spec)
-            specs_to_check.extend([recipe + "@" + version for version in versions[:max_versions]])
-    return specs_to_check
+    The safe versions of a package only change with its recipe, so they can be cached
+    across runs by the git commit of spack. Return "" when not in a git checkout
+    or when recipes have local changes, as these are not part of the commit.
+    """
+    err, commit, _ = run(["git", "rev-parse", "HEAD"])
+    if err or not commit:
+        return ""
+    err, changes, _ = run(["git", "status", "--porcelain", "--", "var/spack/repos"])
+    if err or changes:
+        return ""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "build_pr_changes", f"safe_versions_{commit}.json")
+
+
+def load_safe_versions_cache(cache_path: str) -> Dict[str, List[str]]:
+    """Load the cached safe versions of the packages, if there are any."""
+    if not cache_path or not os.path.exists(cache_path):
+        return {}
+    try:
+        with open(cache_path, encoding="utf-8") as cache:
+            return json.load(cache)
+    except (OSError, ValueError) as e:
+        info("Ignoring the cache %s: %s", cache_path, e)
+        return {}
+
+
+def save_safe_versions_cache(cache_path: str, safe_versions: Dict[str, List[str]]):
+    """Save the safe versions of the packages to the cache for the next run.
+
+    Empty results are not saved as they may be caused by errors running `bin/spack`.
+    """
+    if not cache_path:
+        return
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, "w", encoding="utf-8") as cache:
+            json.dump(
+                {package: versions for package, versions in safe_versions.items() if versions},
+                cache,
+            )
+    except OSError as e:
+        info("Failed to save the cache %s: %s", cache_path, e)
 
 
-def check_all_downloads(specs):
-    """Check if the sources for installing those specs can be downloaded."""
+def expand_specs_to_check_package_versions(specs_to_check, max_versions) -> List[str]:
+    """Expand the specs to check by adding the safe versions of the packages."""
+    cache_path = get_safe_versions_cache_path()
+    safe_versions = load_safe_versions_cache(cache_path)
+
+    # Get the safe versions of each package once, using threads to run `bin/spack` in parallel:
+    packages = dict.fromkeys(spec.partition("@")[0].partition("+")[0] for spec in specs_to_check)
+    missing = [package for package in packages if package not in safe_versions]
+    if missing:
+        with ThreadPoolExecutor(max_workers=min(8, len(missing))) as executor:
+            safe_versions.update(zip(missing, executor.map(get_safe_versions, missing)))
+        save_safe_versions_cache(cache_path, safe_versions)
+
+    # Build a new list, expanding e.g. foo@1.1 and foo@1.2 to the safe versions of foo once:
+    expanded_specs = []
+    expanded = set()
+    for spec in specs_to_check:
+        recipe = spec.partition("@")[0]
+        versions = safe_versions[recipe.partition("+")[0]]
+        if not versions:
+            expanded_specs.append(spec)
+        elif recipe not in expanded:
+            expanded.add(recipe)
+            expanded_specs.extend(recipe + "@" + version for version in versions[:max_versions])
+    return expanded_specs
+
+
+def check_all_downloads(specs, args):
+    """Check if the sources for installing those specs can be downloaded.
+
+    The fetches are bound by network latency, so run up to 8 of them concurrently.
+    Their output is captured and shown when each fetch is done to not interleave it.
+    """
     fetch_flags = ["--fresh", "--fresh-roots", "--deprecated"]
-    for spec in specs:
-        info(f"download+sha256 check {specs.index(spec) + 1} of {len(specs)}: {spec}")
-        ret = spawn("bin/spack", ["fetch", *fetch_flags, spec])
-        if ret:
-            return ret
+    if args.interactive or len(specs) < 2:
+        for i, spec in enumerate(specs, 1):
+            info(f"download+sha256 check {i} of {len(specs)}: {spec}")
+            ret = spawn("bin/spack", ["fetch", *fetch_flags, spec], args.interactive)
+            if ret:
+                return ret
+        return 0
+
+    with ThreadPoolExecutor(max_workers=min(8, len(specs))) as executor:
+        fetches = {
+            executor.submit(run, ["bin/spack", "fetch", *fetch_flags, spec]): spec
+            for spec in specs
+        }
+        for i, fetch in enumerate(as_completed(fetches), 1):
+            ret, out, err = fetch.result()
+            info(f"download+sha256 check {i} of {len(specs)}: {fetches[fetch]}")
+            if out:
+                print(out)
+            # Show the warnings of spack from stderr as well, not only when the fetch failed:
+            if err:
+                print(err)
+            if ret:
+                # Cancel the pending fetches, the running fetches are waited for:
+                for pending in fetches:
+                    pending.cancel()
+                return ret
     return 0
 
 
-def spack_install(specs):
-    """Install the packages."""
-    passed = []
-    failed = []
-    for spec in specs:
-        if spec.startswith("composable-kernel"):
-            print("Skipping composable-kernel: Without a fast GPU, it takes too long.")
-            continue
+def install_summary(log_path: str) -> List[str]:
+    """Get the messages of spack from the tail of the log of `spack install`.
 
-        print(f"\nspack install -v {spec} # {specs.index(spec) + 1} of {len(specs)}\n")
-        # TODO: Add support for installing the packages in a container, sandbox, or remote host.
+    These show the installed spec, its hash, the timings and the installation prefix.
+    Build logs can contain bytes which are not valid UTF-8, so these are replaced.
+    """
+    with open(log_path, encoding="utf-8", errors="replace") as log:
+        tail = deque(log, maxlen=INSTALL_TAIL_LINES)
+    return [line.rstrip() for line in tail if line.startswith("==> ") or line.startswith("[+] ")]
 
-        # TODO: Concertize the the spec before installing to record the exact dependencies.
 
-        cmd = ["install", "-v", "--fail-fast", "--deprecated", spec]
-        ret = spawn("bin/spack", cmd)
-        if ret == 0:
-            print(f"\n------------------------- Passed {spec} -------------------------")
-            passed.append(spec)
-        else:
-            print(f"\n------------------------- FAILED {spec} -------------------------")
-            print("\nFailed command:", " ".join(["bin/spack", *cmd]) + "\n")
-            sleep(5)
-            failed.append(spec)
+def get_log_path(log_dir: str, spec: str) -> str:
+    """Get the path of the log file for installing the spec."""
+    return os.path.join(log_dir, spec.replace("/", "_") + ".log")
+
+
+def install_spec(spec: str, cmd: List[str], log_path: str) -> Tuple[str, int]:
+    """Run `bin/spack <cmd>` in a worker process, writing its output to log_path."""
+    with open(log_path, "w", encoding="utf-8") as log:
+        proc = subprocess.run(
+            ["bin/spack", *cmd],
+            check=False,
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        )
+        return spec, proc.returncode
 
-    return passed, failed
+
+def spack_install_concurrently(
+    specs: List[str], install_flags: List[str], concurrent_packages: int, log_dir: str
+):
+    """Install the packages using a pool of up to concurrent_packages workers.
+
+    The output of each `spack install` is written to a log file per spec
+    as the outputs of concurrent builds can't be shown interleaved.
+    """
+    passed = []
+    failed = []
+    summaries = {}
+    print(f"Installing {len(specs)} specs, {concurrent_packages} at a time, logs in {log_dir}")
+    with ProcessPoolExecutor(max_workers=min(concurrent_packages, len(specs))) as executor:
+        installs = {}
+        for spec in specs:
+            cmd = ["install", *install_flags, spec]
+            log_path = get_log_path(log_dir, spec)
+            installs[executor.submit(install_spec, spec, cmd, log_path)] = (spec, log_path)
+
+        for future in as_completed(installs):
+            spec, log_path = installs[future]
+            try:
+                ret = future.result()[1]
+            except OSError as e:
+                # Failing to write the log or to start spack fails only this spec:
+                print(f"Failed to install {spec}: {e}")
+                ret = 1
+            if ret == 0:
+                print(f"------------------------- Passed {spec} -------------------------")
+                passed.append(spec)
+                summaries[spec] = install_summary(log_path)
+            else:
+                print(f"------------------------- FAILED {spec} -------------------------")
+                print("Log:", log_path)
+                failed.append(spec)
+
+    return passed, failed, summaries
+
+
+def spack_install(specs, args):
+    """Install the packages.
+
+    Return the passed and failed specs and the summaries of spack for the passed specs.
+    """
+    passed = []
+    failed = []
+    summaries = {}
+    if any(spec.startswith("composable-kernel") for spec in specs):
+        print("Skipping composable-kernel: Without a fast GPU, it takes too long.")
+        specs = [spec for spec in specs if not spec.startswith("composable-kernel")]
+
+    install_flags = ["-v", "--fail-fast", "--deprecated"]
+    # Each `spack install` runs `make -j<ncpus>` by default, which would oversubscribe
+    # the CPUs when installing concurrently: Divide the jobs between the concurrent installs.
+    if args.jobs or args.concurrent_packages > 1:
+        jobs = args.jobs or os.cpu_count() or 1
+        install_flags += ["-j", str(max(1, jobs // args.concurrent_packages))]
+
+    if args.concurrent_packages > 1 and len(specs) > 1:
+        # Keep the logs of concurrent installs, as they are the only record of their output:
+        log_dir = tempfile.mkdtemp(prefix="build_pr_changes-")
+        return spack_install_concurrently(specs, install_flags, args.concurrent_packages, log_dir)
+
+    # The output of serial installs is shown, their logs are only for getting the summaries:
+    with tempfile.TemporaryDirectory(prefix="build_pr_changes-") as log_dir:
+        for i, spec in enumerate(specs, 1):
+            print(f"\nspack install -v {spec} # {i} of {len(specs)}\n")
+            # TODO: Add support for installing the packages in a container, sandbox, or remote host.
+
+            # TODO: Concertize the the spec before installing to record the exact dependencies.
+
+            cmd = ["install", *install_flags, spec]
+            log_path = "" if args.interactive else get_log_path(log_dir, spec)
+            ret = spawn("bin/spack", cmd, args.interactive, log_path)
+            if ret == 0:
+                print(f"\n------------------------- Passed {spec} -------------------------")
+                passed.append(spec)
+                if log_path:
+                    summaries[spec] = install_summary(log_path)
+            else:
+                print(f"\n------------------------- FAILED {spec} -------------------------")
+                print("\nFailed command:", " ".join(["bin/spack", *cmd]) + "\n")
+                if args.pause_on_fail:
+                    sleep(args.pause_on_fail)
+                failed.append(spec)
+            # Remove the log once read, as the logs of builds can be large:
+            if log_path:
+                os.remove(log_path)
+
+    return passed, failed, summaries
+
+
+def positive_int(value: str) -> int:
+    """Parse a positive integer command line argument."""
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a positive integer")
+    return number
 
 
 def parse_args() -> argparse.Namespace:
@@ -238,6 +569,11 @@ def parse_args() -> argparse.Namespace:
     # -d, --download: Download and checksum check only.
     # -s=<versions>, --safe-versions=<versions>: Install <versions> safe versions of the packages.
     # -u, --uninstall: Uninstall the installed packages.
+    # -c=<n>, --concurrent-packages=<n>: Install up to <n> specs concurrently.
+    # -j=<n>, --jobs=<n>: Number of build jobs, divided between the concurrent installs.
+    # -i, --interactive: Run spack in a pseudo-terminal to allow answering its prompts.
+    # -v, --verbose-report: Add the output of `spack find -v` to the report.
+    # -p=<seconds>, --pause-on-fail=<seconds>: Pause after a failed install.
     argparser = argparse.ArgumentParser(description=__doc__)
     argparser.add_argument(
         "-l", "--label-success", action="store_true", help="Label the PR on success."
@@ -254,11 +590,52 @@ def parse_args() -> argparse.Namespace:
     argparser.add_argument(
         "-u", "--uninstall", action="store_true", help="Uninstall the installed packages."
     )
-    return argparser.parse_args()
+    argparser.add_argument(
+        "-c",
+        "--concurrent-packages",
+        type=positive_int,
+        default=1,
+        help="Install up to <n> specs concurrently, logging the output of each to a file.",
+    )
+    argparser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        help="Build jobs to use, divided between concurrent installs (default: CPU count).",
+    )
+    argparser.add_argument(
+        "-i",
+        "--interactive",
+        action="store_true",
+        help="Run spack in a pseudo-terminal to allow answering its prompts.",
+    )
+    argparser.add_argument(
+        "-v",
+        "--verbose-report",
+        action="store_true",
+        help="Add the output of `spack find -v` for the installed specs to the report.",
+    )
+    argparser.add_argument(
+        "-p",
+        "--pause-on-fail",
+        type=float,
+        default=0,
+        help="Pause <seconds> after a failed install to allow reading its output.",
+    )
+    args = argparser.parse_args()
+    if args.interactive and args.concurrent_packages > 1:
+        argparser.error("--interactive can't be used with --concurrent-packages > 1")
+    return args
 
 
 def main(args) -> int:
     """Run the main code for the script using the parsed command line flags"""
+    # Like spack, use forkserver for the worker processes for concurrent installs:
+    # It starts the workers faster than spawn and does not fork this process with
+    # locks held. This is safe as no threads or SSL contexts are created before this.
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        multiprocessing.set_start_method("forkserver", force=True)
+
     # TODO:
     # - Add support for installing the packages in a container, sandbox, or remote host.
     #   Use pxssh module of pexpect: https://pexpect.readthedocs.io/en/stable/api/pxssh.html
@@ -278,7 +655,7 @@ def main(args) -> int:
     # This can be skipped as some packages like rust don't have a checksum,
     # and the download is done by the install command anyway.
     if args.download:
-        return check_all_downloads(specs_to_check)
+        return check_all_downloads(specs_to_check, args)
 
     # Check if specs are already installed and ask if they should be uninstalled.
     installed, findings = find_already_installed(specs_to_check)
@@ -289,37 +666,42 @@ def main(args) -> int:
             if input("Uninstall them? [y/n]: ").lower() == "y":
                 spack_uninstall_packages(installed)
                 installed = []
+                findings = []
 
     for already_installed_pkg in installed:
         specs_to_check.remove(already_installed_pkg)
 
-    passed, failed = spack_install(specs_to_check)
+    passed, failed, summaries = spack_install(specs_to_check, args)
 
     # Generate a report in markdown format for cut-and-paste into the PR comment:
     about_build_host, os_name, os_version_id = get_os_info()
 
-    print(f"Build results{about_build_host}:")
-    print("```py")
+    report = [f"Build results{about_build_host}:", "```py"]
     if passed + installed:
         done = " ".join(installed + passed)
         if len(done) < 80:
-            print("Passed:", done)
+            report.append("Passed: " + done)
         else:
-            print("Passed:\n" + "\n".join(installed + passed))
+            report.append("Passed:\n" + "\n".join(installed + passed))
     if failed:
-        print("\nFailed:", " ".join(failed))
+        report.append("\nFailed: " + " ".join(failed))
         # TODO: Add support for showing details about the failed specs.
 
     # TODO: Add showing "group" infos like compiler version, cmake version, etc.:
-    print("spack find -v:")
-    err, stdout, stderr = run(["bin/spack", "find", "-v", *(installed + passed)])
-    if not err:
-        print(stdout)
-    else:
-        print(stderr or stdout)
-    print("```")
-    print("Generated by:")
-    print("https://github.com/spack/build-quality-tools/blob/main/build_pr_changes.py")
+    if args.verbose_report:
+        report.append("spack find -v:")
+        err, stdout, stderr = run(["bin/spack", "find", "-v", *(installed + passed)])
+        report.append(stderr or stdout if err else stdout)
+    elif findings or summaries:
+        # Reuse the output of `spack find` and `spack install` instead of running spack again:
+        report.append("Installed:")
+        report.extend(findings)
+        for spec in passed:
+            report.extend(summaries.get(spec, []))
+    report.append("```")
+    report.append("Generated by:")
+    report.append("https://github.com/spack/build-quality-tools/blob/main/build_pr_changes.py")
+    sys.stdout.write("\n".join(report) + "\n")
     if failed or not passed + installed:
         return 1
     if args.label_success:
@@ -330,6 +712,10 @@ def main(args) -> int:
 
 def parse_args_and_run():
     """Parse the command line arguments and run the main function."""
+    # Flush each line, so our output is in order with the output of spawned commands
+    # even when stdout is not a terminal, e.g. when piping the output to tee:
+    if isinstance(sys.stdout, io.TextIOWrapper):
+        sys.stdout.reconfigure(line_buffering=True, write_through=True)
     ret = main(parse_args())
     if ret:
         sys.exit(ret)